@@ -1,82 +1,220 @@
-from collections import namedtuple
+import hashlib
+import marshal
+from opcode import opmap
 from types import CodeType
 
 from bytecode import Bytecode, Instr, SetLineno
 
 
+_patched_code_cache = {}
+_patched_code_by_content = {}
+
+
 def patch_code(code):
+    cached = _patched_code_cache.get(id(code))
+    if cached is not None:
+        return cached[1]
+
+    # The same code may be loaded again as a new object (e.g. on importlib.reload()),
+    # so we also look up the results by the digest of its content
+    content_key = get_content_key(code)
+    patched_code = _patched_code_by_content.get(content_key) if content_key is not None else None
+    if patched_code is not None:
+        _patched_code_cache[id(code)] = (code, patched_code)
+        return patched_code
+
+    # Nested code objects are patched before their parents (without recursion),
+    # so patching a parent only needs to look up the results in the cache
+    for item in collect_unpatched_code(code):
+        # Keep a reference to the original code object, so its id can't be reused
+        _patched_code_cache[id(item)] = (item, _patch_code(item))
+    patched_code = _patched_code_cache[id(code)][1]
+
+    if content_key is not None:
+        _patched_code_by_content[content_key] = patched_code
+    return patched_code
+
+
+def get_content_key(code):
+    # Equal code objects may still differ in co_filename and line numbers, so we hash
+    # the marshalled code (including nested code objects) instead of relying on code.__eq__()
+    try:
+        return hashlib.blake2b(marshal.dumps(code), digest_size=16).digest()
+    except ValueError:  # The code contains unmarshallable constants
+        return None
+
+
+def collect_unpatched_code(code):
+    """
+    Returns the code objects reachable via co_consts that are not patched yet, children first.
+    """
+
+    result = []
+    visited = set()
+    stack = [(code, False)]
+    while stack:
+        item, children_collected = stack.pop()
+        if children_collected:
+            result.append(item)
+            continue
+
+        key = id(item)
+        if key in visited or key in _patched_code_cache:
+            continue
+        visited.add(key)
+
+        stack.append((item, True))
+        stack.extend((const, False) for const in item.co_consts if isinstance(const, CodeType))
+    return result
+
+
+def _patch_code(code):
+    if not has_unary_ops(code):
+        # Avoid the expensive Bytecode.from_code() and to_code() round-trip
+        return patch_nested_code(code)
+
     bytecode = Bytecode.from_code(code)
+    # The patch_*_region() functions work on a plain list of instructions. The other items
+    # (labels, SetLineno) are kept aside and mapped to the index of the next instruction
+    instrs = []
+    markers = {}
+    for item in bytecode:
+        if isinstance(item, Instr):
+            instrs.append(item)
+        else:
+            markers.setdefault(len(instrs), []).append(item)
     new_bytecode = []
 
+    # Only the code rewritten by pytest may capture intermediate values
+    pytest_rewritten = any(name.startswith(PYTEST_CAPTURING_PREFIX) for name in code.co_varnames)
+
+    # Bind the callables used for each instruction to locals to avoid repeated lookups
+    try_increment = patch_increment_region
+    try_load_code = patch_load_code_region
+    append = new_bytecode.append
+    extend = new_bytecode.extend
+
+    changed = False
     index = 0
-    while index < len(bytecode):
-        patch = patch_increment_region(bytecode[index:index + 7], code)
+    n = len(instrs)
+    while index < n:
+        preceding_markers = markers.get(index)
+        if preceding_markers is not None:
+            extend(preceding_markers)
+
+        patch = try_increment(instrs, markers, index, code, pytest_rewritten)
         if patch is None:
-            patch = patch_load_code_region(bytecode[index:index + 1])
+            patch = try_load_code(instrs, index)
         if patch is None:
-            patch = Patch(n_removed=1, added=[bytecode[index]])
+            append(instrs[index])
+            index += 1
+            continue
+
+        n_removed, added = patch
+        changed = True
+        index += n_removed
+        extend(added)
+    extend(markers.get(n, []))
 
-        index += patch.n_removed
-        new_bytecode.extend(patch.added)
+    if not changed:
+        # E.g. the code has only single unary ops, skip the expensive to_code() call
+        return code
 
-    bytecode.clear()
-    bytecode.extend(new_bytecode)
+    bytecode[:] = new_bytecode
     return bytecode.to_code()
 
 
-Patch = namedtuple('Patch', ['n_removed', 'added'])
+def has_unary_ops(code):
+    # Since Python 3.6, each instruction takes 2 bytes, and the opcode goes first
+    return not UNARY_OPCODES.isdisjoint(code.co_code[::2])
 
 
-def patch_increment_region(region, code):
-    n_removed = 3
+def patch_nested_code(code):
+    consts = tuple(patch_code(const) if isinstance(const, CodeType) else const
+                   for const in code.co_consts)
+    if all(new is old for new, old in zip(consts, code.co_consts)):
+        return code
+    return replace_consts(code, consts)
 
-    if is_pytest_intermediate_value_capturing(region[1:3]):
-        # Remove capturing of the LOAD_ATTR/BINARY_SUBSCR result
-        region[1:3] = []
-        n_removed += 2
-    if is_pytest_intermediate_value_capturing(region[2:4]):
-        # Remove capturing of the first UNARY_POSITIVE/NEGATIVE result
-        region[2:4] = []
-        n_removed += 2
 
-    if not (len(region) >= 3 and
-            all(isinstance(item, Instr) for item in region[:3]) and
-            region[1].name in UNARY_TO_INPLACE_OP and
-            region[1].name == region[2].name):
+def replace_consts(code, consts):
+    if hasattr(code, 'replace'):  # Python 3.8+
+        return code.replace(co_consts=consts)
+    return CodeType(
+        code.co_argcount, code.co_kwonlyargcount, code.co_nlocals, code.co_stacksize,
+        code.co_flags, code.co_code, consts, code.co_names, code.co_varnames,
+        code.co_filename, code.co_name, code.co_firstlineno, code.co_lnotab,
+        code.co_freevars, code.co_cellvars)
+
+
+def patch_increment_region(instrs, markers, index, code, pytest_rewritten):
+    """
+    Looks for two identical unary ops applied to the result of the op at instrs[index].
+    Returns None or a (n_removed, added) tuple, like other patch_*_region() functions.
+    """
+
+    # Fast rejection for most of the instructions: the next op must be either a unary op or
+    # STORE_FAST starting pytest's capturing of the loaded value
+    if index + 2 >= len(instrs):
+        return None
+    next_opcode = instrs[index + 1].opcode
+    if not (next_opcode in UNARY_OPCODES or
+            (pytest_rewritten and next_opcode == STORE_FAST_OPCODE)):
+        return None
+
+    first_unary_index = index + 1
+    if pytest_rewritten and is_pytest_intermediate_value_capturing(instrs, first_unary_index):
+        # Skip capturing of the LOAD_ATTR/BINARY_SUBSCR result
+        first_unary_index += 2
+    second_unary_index = first_unary_index + 1
+    if pytest_rewritten and is_pytest_intermediate_value_capturing(instrs, second_unary_index):
+        # Skip capturing of the first UNARY_POSITIVE/NEGATIVE result
+        second_unary_index += 2
+
+    if second_unary_index >= len(instrs):
+        return None
+    # Compare opcodes (small ints) instead of op names
+    unary_opcode = instrs[first_unary_index].opcode
+    if unary_opcode not in UNARY_OPCODES or instrs[second_unary_index].opcode != unary_opcode:
+        return None
+    # A label inside the region means that a jump target
+    # (e.g. the end of the `a if cond else b` expression) separates the ops
+    if any(i in markers for i in range(index + 1, second_unary_index + 1)):
         return None
-    load_instr, unary_instr = region[:2]
 
-    if load_instr.name not in LOAD_TO_STORE_OP:
+    load_instr = instrs[index]
+    template = INCREMENT_TEMPLATES.get((load_instr.opcode, unary_opcode))
+    if template is None:
         raise make_syntax_error('Increment/decrement may be applied only to a variable, '
                                 'a subscriptable item, or an attribute', load_instr.lineno, code)
 
-    repl = [SetLineno(load_instr.lineno)]
-    repl += PRE_LOAD_HOOK.get(load_instr.name, [])
-    repl += [
+    before_load, after_load, store_op = template
+    repl = [
+        SetLineno(load_instr.lineno),
+        *before_load,
         load_instr,
-        Instr('LOAD_CONST', 1),
-        Instr(UNARY_TO_INPLACE_OP[unary_instr.name]),
-        Instr('DUP_TOP'),  # One to store, one to return
+        *after_load,
+        Instr(store_op, load_instr.arg),
     ]
 
-    store_op = LOAD_TO_STORE_OP[load_instr.name]
-    repl += PRE_STORE_HOOK.get(store_op, [])
-    repl.append(Instr(store_op, load_instr.arg))
-
-    return Patch(n_removed=n_removed, added=repl)
+    n_removed = second_unary_index - index + 1
+    return n_removed, repl
 
 
-def patch_load_code_region(region):
-    if not (isinstance(region[0], Instr) and
-            region[0].name == 'LOAD_CONST' and
-            isinstance(region[0].arg, CodeType)):
+def patch_load_code_region(instrs, index):
+    load_const_instr = instrs[index]
+    if not (load_const_instr.opcode == LOAD_CONST_OPCODE and
+            isinstance(load_const_instr.arg, CodeType)):
+        return None
+    nested_code = load_const_instr.arg
+    patched_nested_code = patch_code(nested_code)
+    if patched_nested_code is nested_code:
         return None
-    load_const_instr = region[0]
 
     repl = [
-        Instr('LOAD_CONST', patch_code(load_const_instr.arg), lineno=load_const_instr.lineno),
+        Instr('LOAD_CONST', patched_nested_code, lineno=load_const_instr.lineno),
     ]
-    return Patch(n_removed=1, added=repl)
+    return 1, repl
 
 
 def make_syntax_error(message, lineno, code):
@@ -84,7 +222,7 @@ def make_syntax_error(message, lineno, code):
         code.co_filename, lineno, code.co_name, message))
 
 
-def is_pytest_intermediate_value_capturing(region):
+def is_pytest_intermediate_value_capturing(instrs, index):
     """
     pytest rewrites asserts in test functions to save each intermediate result of the expressions.
     This divides consecutive ops (e.g. two UNARY_POSITIVE ops) with STORE_FAST and LOAD_FAST
@@ -93,10 +231,14 @@ def is_pytest_intermediate_value_capturing(region):
     See https://docs.pytest.org/en/stable/assert.html#assertion-introspection-details
     """
 
-    return (all(isinstance(item, Instr) for item in region) and
-            [item.name for item in region] == ['STORE_FAST', 'LOAD_FAST'] and
-            region[0].arg == region[1].arg and
-            region[0].arg.startswith('@py_assert'))
+    if index + 1 >= len(instrs):
+        return False
+    store_instr = instrs[index]
+    load_instr = instrs[index + 1]
+    if store_instr.opcode != STORE_FAST_OPCODE or load_instr.opcode != LOAD_FAST_OPCODE:
+        return False
+    var_name = store_instr.arg
+    return var_name == load_instr.arg and var_name.startswith(PYTEST_CAPTURING_PREFIX)
 
 
 UNARY_TO_INPLACE_OP = {
@@ -104,6 +246,14 @@ UNARY_TO_INPLACE_OP = {
     'UNARY_NEGATIVE': 'INPLACE_SUBTRACT',
 }
 
+UNARY_OPCODES = frozenset(opmap[name] for name in UNARY_TO_INPLACE_OP)
+
+PYTEST_CAPTURING_PREFIX = '@py_assert'
+
+LOAD_CONST_OPCODE = opmap['LOAD_CONST']
+LOAD_FAST_OPCODE = opmap['LOAD_FAST']
+STORE_FAST_OPCODE = opmap['STORE_FAST']
+
 LOAD_TO_STORE_OP = {
     'LOAD_DEREF': 'STORE_DEREF',
     'LOAD_FAST': 'STORE_FAST',
@@ -138,3 +288,25 @@ PRE_STORE_HOOK = {
         Instr('ROT_TWO'),
     ],
 }
+
+
+def make_increment_template(load_name, unary_name):
+    # The patched code: [*before_load, <load op>, *after_load, <store op>]
+    store_op = LOAD_TO_STORE_OP[load_name]
+    before_load = PRE_LOAD_HOOK.get(load_name, [])
+    after_load = [
+        Instr('LOAD_CONST', 1),
+        Instr(UNARY_TO_INPLACE_OP[unary_name]),
+        Instr('DUP_TOP'),  # One to store, one to return
+        *PRE_STORE_HOOK.get(store_op, []),
+    ]
+    return before_load, after_load, store_op
+
+
+# Built once, so patching an increment doesn't allocate the same instructions every time.
+# The keys are (load opcode, unary opcode) pairs since comparing ints is cheaper than names
+INCREMENT_TEMPLATES = {
+    (opmap[load_name], opmap[unary_name]): make_increment_template(load_name, unary_name)
+    for load_name in LOAD_TO_STORE_OP
+    for unary_name in UNARY_TO_INPLACE_OP
+}
@@ -26,14 +26,22 @@ def enable_increments(where):
 
 class PatchingFinder(importlib.abc.MetaPathFinder):
     _patched_import_paths = set()
+    # Maps each component of a patched import path to the trie of the following components,
+    # the end of the path is marked with the None key
+    _patched_path_trie = {}
+    _patched_roots = frozenset()
 
     @classmethod
     def find_spec(cls, fullname, path, target=None):
+        # The finder is consulted on every import, so reject unrelated packages right away
+        if fullname.partition('.')[0] not in cls._patched_roots:
+            return None
         if not cls._is_patching_needed(fullname):
             return None
 
         for finder in sys.meta_path:
-            if finder is cls:
+            # Skip legacy finders that don't provide find_spec()
+            if finder is cls or not hasattr(finder, 'find_spec'):
                 continue
 
             spec = finder.find_spec(fullname, path, target)
@@ -44,9 +52,14 @@ class PatchingFinder(importlib.abc.MetaPathFinder):
 
     @classmethod
     def _is_patching_needed(cls, import_path):
-        import_path = import_path.split('.')
-        return any('.'.join(import_path[:i]) in cls._patched_import_paths
-                   for i in range(len(import_path) + 1))
+        node = cls._patched_path_trie
+        for component in import_path.split('.'):
+            node = node.get(component)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
 
     @classmethod
     def register_import_path(cls, import_path):
@@ -55,13 +68,50 @@ class PatchingFinder(importlib.abc.MetaPathFinder):
 
         cls._patched_import_paths.add(import_path)
 
+        node = cls._patched_path_trie
+        for component in import_path.split('.'):
+            node = node.setdefault(component, {})
+        node[None] = True
+
+        cls._patched_roots = frozenset(cls._patched_path_trie)
+
+    @classmethod
+    def detach(cls):
+        """
+        Removes the finder from sys.meta_path and forgets all registered import paths,
+        so that further imports don't pass through it. Already imported modules remain patched.
+        """
+
+        if cls in sys.meta_path:
+            sys.meta_path.remove(cls)
+
+        cls._patched_import_paths.clear()
+        cls._patched_path_trie.clear()
+        cls._patched_roots = frozenset()
+
 
 class PatchingLoader(importlib.abc.InspectLoader):
     def __init__(self, wrapped_loader):
         self._wrapped_loader = wrapped_loader
 
+    def __getattr__(self, name):
+        # Forward the rest of the loader API (e.g. get_filename() or get_resource_reader()).
+        # _wrapped_loader may be unset if the object is created without __init__()
+        # (e.g. by copy or pickle), so we avoid infinite recursion in this case
+        if name == '_wrapped_loader':
+            raise AttributeError(name)
+        return getattr(self._wrapped_loader, name)
+
     def get_code(self, fullname):
         return patch_code(self._wrapped_loader.get_code(fullname))
 
     def get_source(self, fullname):
         return self._wrapped_loader.get_source(fullname)
+
+    def is_package(self, fullname):
+        # Defined explicitly since InspectLoader.is_package() would raise ImportError
+        return self._wrapped_loader.is_package(fullname)
+
+    @staticmethod
+    def source_to_code(data, path='<string>'):
+        return patch_code(importlib.abc.InspectLoader.source_to_code(data, path))
@@ -1,7 +1,18 @@
+import copy
+import inspect
+import pickle
+import sys
+from contextlib import contextmanager
+from importlib.machinery import PathFinder
+from unittest import mock
+
 import pytest
 from bytecode import Bytecode, Instr
 
 from plusplus import enable_increments
+from plusplus import patching
+from plusplus.patching import patch_code, replace_consts
+from plusplus.wrappers import PatchingFinder, PatchingLoader
 
 
 @enable_increments
@@ -182,6 +193,20 @@ def test_package():
     assert increment_and_return(42) == 43
     assert CONSTANT == 778
 
+    # Test that the rest of the loader API is forwarded to the original loader
+    from package_with_increments import module
+    loader = module.__loader__
+    assert not loader.is_package(module.__name__)
+    assert loader.get_filename(module.__name__) == module.__file__
+
+    for source_to_code in [loader.source_to_code, PatchingLoader.source_to_code]:
+        namespace = {}
+        exec(source_to_code('x = 0\n++x'), namespace)
+        assert namespace['x'] == 1
+
+    for loader_copy in [copy.copy(loader), pickle.loads(pickle.dumps(loader))]:
+        assert loader_copy.get_filename(module.__name__) == module.__file__
+
     with pytest.raises(ImportError):
         from package_with_increments import unknown_unknowns
 
@@ -189,6 +214,69 @@ def test_package():
     import imaplib as _
 
 
+@contextmanager
+def restored_finder_state():
+    registered_paths = set(PatchingFinder._patched_import_paths)
+    try:
+        yield
+    finally:
+        PatchingFinder.detach()
+        for import_path in registered_paths:
+            enable_increments(import_path)
+
+
+def test_patched_import_paths():
+    with restored_finder_state():
+        enable_increments('nonexistent_package.subpackage')
+
+        assert PatchingFinder._is_patching_needed('nonexistent_package.subpackage')
+        assert PatchingFinder._is_patching_needed('nonexistent_package.subpackage.module')
+
+        assert not PatchingFinder._is_patching_needed('nonexistent_package')
+        assert not PatchingFinder._is_patching_needed('nonexistent_package.subpackage_suffix')
+        assert not PatchingFinder._is_patching_needed('nonexistent_package.another_subpackage')
+        assert not PatchingFinder._is_patching_needed('subpackage')
+    assert not PatchingFinder._is_patching_needed('nonexistent_package.subpackage')
+
+
+def test_finder_detaching():
+    with restored_finder_state():
+        enable_increments('package_with_increments')
+        assert sys.meta_path.count(PatchingFinder) == 1
+
+        PatchingFinder.detach()
+        assert PatchingFinder not in sys.meta_path
+        assert not PatchingFinder._is_patching_needed('package_with_increments.module')
+
+        enable_increments('package_with_increments')
+        assert sys.meta_path.count(PatchingFinder) == 1
+        assert PatchingFinder._is_patching_needed('package_with_increments.module')
+
+
+def test_finder_delegation():
+    module_name = 'package_with_increments'
+
+    with restored_finder_state():
+        enable_increments('package_with_increments')
+
+        # Legacy finders without find_spec() are skipped
+        class LegacyFinder:
+            pass
+
+        sys.meta_path.insert(1, LegacyFinder)
+        try:
+            assert PatchingFinder.find_spec(module_name, None) is not None
+        finally:
+            sys.meta_path.remove(LegacyFinder)
+
+        # find_spec() of other finders is looked up on every call, so patching it takes effect
+        with mock.patch.object(PathFinder, 'find_spec',
+                               side_effect=PathFinder.find_spec) as find_spec:
+            spec = PatchingFinder.find_spec(module_name, None)
+        assert isinstance(spec.loader, PatchingLoader)
+        find_spec.assert_called_once_with(module_name, None, None)
+
+
 def test_type_errors():
     with pytest.raises(TypeError):
         @enable_increments
@@ -233,3 +321,77 @@ def test_expected_ops_are_used():
                        for item in Bytecode.from_code(test_func.__code__)
                        if isinstance(item, Instr)), \
                 '{} expected to have {}'.format(test_func.__name__, op)
+
+
+def test_patching_is_memoized():
+    def increment_and_return(x):
+        return ++x
+
+    code = increment_and_return.__code__
+    assert patch_code(code) is patch_code(code)
+
+    # Compiling the same source again (e.g. on importlib.reload()) makes equal code objects
+    source = 'def increment_and_return(x):\n    return ++x\n'
+    first_code = compile(source, '<memoized>', 'exec')
+    second_code = compile(source, '<memoized>', 'exec')
+    assert first_code is not second_code
+    assert patch_code(first_code) is patch_code(second_code)
+
+    # Code from another file must keep its own co_filename
+    another_code = compile(source, '<another_file>', 'exec')
+    assert patch_code(another_code).co_filename == '<another_file>'
+
+
+def test_deeply_nested_code():
+    depth = 90  # Python allows at most 100 indentation levels
+    source = ''.join('    ' * level + 'def f{}():\n'.format(level) for level in range(depth))
+    source += '    ' * depth + 'x = 0\n'
+    source += '    ' * depth + 'return ++x\n'
+    source += ''.join('    ' * level + 'return f{}()\n'.format(level)
+                      for level in reversed(range(1, depth)))
+    namespace = {}
+    exec(compile(source, '<deeply_nested_code>', 'exec'), namespace)
+
+    # Patching nested code objects doesn't recurse, so the stack depth doesn't grow with nesting
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(len(inspect.stack(0)) + 40)
+    try:
+        patched_func = enable_increments(namespace['f0'])
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+    assert patched_func() == 1
+
+
+def test_shared_nested_code_is_patched_once():
+    def make_closure():
+        def closure(x):
+            return ++x
+        return closure
+
+    parent_code = make_closure.__code__
+    # Another code object that shares the same nested code object
+    another_parent_code = replace_consts(parent_code, parent_code.co_consts + ('unused',))
+    closure_code, = [const for const in parent_code.co_consts if inspect.iscode(const)]
+
+    with mock.patch.object(patching, '_patch_code', wraps=patching._patch_code) as patch_mock:
+        patched_parent = patch_code(parent_code)
+        patched_another_parent = patch_code(another_parent_code)
+    assert [args[0] for args, _ in patch_mock.call_args_list].count(closure_code) == 1
+
+    patched_closure, = [const for const in patched_parent.co_consts if inspect.iscode(const)]
+    assert patched_closure is not closure_code
+    assert patched_closure in patched_another_parent.co_consts
+
+
+def test_code_without_increments_is_not_rebuilt():
+    def add(x, y):
+        return x + y
+
+    code = add.__code__
+    assert patch_code(code) is code
+
+    def negate_all(items):
+        return [-item for item in items]
+
+    code = negate_all.__code__
+    assert patch_code(code) is code